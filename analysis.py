@@ -8,7 +8,6 @@ import pandas as pd
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-import seaborn as sns
 from scipy.stats import mannwhitneyu
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -17,38 +16,82 @@ DB_PATH = os.path.join(SCRIPT_DIR, "loblaw.db")
 POPULATIONS = ["b_cell", "cd8_t_cell", "cd4_t_cell", "nk_cell", "monocyte"]
 
 
-def get_data_overview(db_path=DB_PATH):
+def _add_percentages(df):
+    """Add per-sample total_count and percentage columns to a long-form frame."""
+    df["total_count"] = df.groupby("sample", sort=False)["count"].transform("sum")
+    df["percentage"] = df["count"] * 100.0 / df["total_count"]
+    return df
+
+
+def _load_cached_stats(conn):
+    """Stats written to stats_cache by load_data.py, or None if missing or stale."""
+    try:
+        cached = pd.read_sql_query("SELECT * FROM stats_cache ORDER BY rowid", conn)
+    except pd.errors.DatabaseError:
+        return None
+    (version,) = conn.execute("PRAGMA user_version").fetchone()
+    if cached.empty or (cached["db_version"] != version).any():
+        return None
+    cached["significant"] = cached["significant"].astype(bool)
+    return cached.drop(columns="db_version")
+
+
+def get_data_overview(db_path=DB_PATH, conn=None, as_arrow=False):
     """Relative frequency of each cell type in each sample.
 
     Returns a DataFrame with columns:
         sample, total_count, population, count, percentage
+
+    With ``as_arrow=True`` the same data comes back as a pyarrow Table, with
+    population dictionary-encoded.
+
+    If ``conn`` is given it is used as-is and left open.
     """
-    conn = sqlite3.connect(db_path)
-    query = """
-        SELECT
-            sample,
-            SUM(count) OVER (PARTITION BY sample) AS total_count,
-            population,
-            count,
-            ROUND(count * 100.0 / SUM(count) OVER (PARTITION BY sample), 2) AS percentage
-        FROM cell_counts
-        ORDER BY sample, population
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(db_path)
+    query = f"""
+        SELECT sample, {", ".join(POPULATIONS)}, total AS total_count
+        FROM cell_counts_wide
     """
-    df = pd.read_sql_query(query, conn)
-    conn.close()
+    wide = pd.read_sql_query(query, conn)
+    if own_conn:
+        conn.close()
+
+    df = wide.melt(
+        id_vars=["sample", "total_count"],
+        value_vars=POPULATIONS,
+        var_name="population",
+        value_name="count",
+    )
+    df["percentage"] = df["count"] * 100.0 / df["total_count"]
+    df = df.sort_values(["sample", "population"], ignore_index=True)
+    df = df[["sample", "total_count", "population", "count", "percentage"]]
+
+    if as_arrow:
+        import pyarrow as pa
+
+        df["population"] = df["population"].astype("category")
+        return pa.Table.from_pandas(df, preserve_index=False)
     return df
 
 
-def get_statistical_analysis(db_path=DB_PATH):
-    """Compare responders vs non-responders for melanoma+miraclib+PBMC.
+def get_statistical_tests(db_path=DB_PATH, conn=None):
+    """Mann-Whitney U tests of responders vs non-responders for melanoma+miraclib+PBMC.
 
     Returns:
         df: DataFrame with columns (sample, subject, response, time_from_treatment_start,
             population, count, percentage)
-        fig: matplotlib Figure with boxplots
         stats_df: DataFrame with Mann-Whitney U test results per population
+
+    The tests are skipped when load_data.py has left a matching stats_cache
+    table in the database.
+
+    If ``conn`` is given it is used as-is and left open.
     """
-    conn = sqlite3.connect(db_path)
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(db_path)
     query = """
         SELECT
             cc.sample,
@@ -56,8 +99,7 @@ def get_statistical_analysis(db_path=DB_PATH):
             sub.response,
             sa.time_from_treatment_start,
             cc.population,
-            cc.count,
-            ROUND(cc.count * 100.0 / SUM(cc.count) OVER (PARTITION BY cc.sample), 2) AS percentage
+            cc.count
         FROM cell_counts cc
         JOIN samples sa ON cc.sample = sa.sample
         JOIN subjects sub ON sa.subject = sub.subject
@@ -67,9 +109,42 @@ def get_statistical_analysis(db_path=DB_PATH):
         ORDER BY cc.sample, cc.population
     """
     df = pd.read_sql_query(query, conn)
-    conn.close()
+    stats_df = _load_cached_stats(conn)
+    if own_conn:
+        conn.close()
+
+    df = _add_percentages(df).drop(columns="total_count")
+    if stats_df is not None:
+        return df, stats_df
+
+    # One row per sample, one column per population, so all five tests run in one call
+    wide = df.pivot(index="sample", columns="population", values="percentage")[POPULATIONS]
+    response = df.drop_duplicates("sample").set_index("sample")["response"].reindex(wide.index)
+    responders = wide[response == "yes"].to_numpy()
+    non_responders = wide[response == "no"].to_numpy()
+
+    stats, pvals = mannwhitneyu(responders, non_responders, alternative="two-sided", axis=0)
+
+    stats_rows = [
+        {
+            "population": pop,
+            "u_statistic": stat,
+            "p_value": round(pval, 6),
+            "significant": pval < 0.05,
+        }
+        for pop, stat, pval in zip(POPULATIONS, stats, pvals)
+    ]
+
+    stats_df = pd.DataFrame(stats_rows)
+    return df, stats_df
+
+
+def build_boxplot_figure(df, stats_df):
+    """Boxplots of responder vs non-responder frequencies, one panel per population.
 
-    # Build boxplots and run statistical tests
+    Takes the two DataFrames returned by get_statistical_tests() and returns a
+    matplotlib Figure.
+    """
     fig, axes = plt.subplots(1, 5, figsize=(22, 5))
     fig.suptitle(
         "Cell Population Frequencies: Responders vs Non-Responders\n"
@@ -78,57 +153,63 @@ def get_statistical_analysis(db_path=DB_PATH):
         y=1.02,
     )
 
-    stats_rows = []
+    results = stats_df.set_index("population")
+    groups = dict(tuple(df.groupby("population", sort=False)))
     for i, pop in enumerate(POPULATIONS):
-        pop_data = df[df["population"] == pop]
-        responders = pop_data[pop_data["response"] == "yes"]["percentage"]
-        non_responders = pop_data[pop_data["response"] == "no"]["percentage"]
-
-        stat, pval = mannwhitneyu(responders, non_responders, alternative="two-sided")
-        significant = pval < 0.05
-
-        stats_rows.append(
-            {
-                "population": pop,
-                "u_statistic": stat,
-                "p_value": round(pval, 6),
-                "significant": significant,
-            }
-        )
-
-        sns.boxplot(
-            data=pop_data,
-            x="response",
-            y="percentage",
-            hue="response",
-            order=["yes", "no"],
-            hue_order=["yes", "no"],
-            ax=axes[i],
-            palette={"yes": "#2ecc71", "no": "#e74c3c"},
-            legend=False,
+        by_response = groups[pop].groupby("response", sort=False)["percentage"]
+        responders = by_response.get_group("yes").to_numpy()
+        non_responders = by_response.get_group("no").to_numpy()
+        pval = results.at[pop, "p_value"]
+
+        bp = axes[i].boxplot(
+            [responders, non_responders],
+            tick_labels=["yes", "no"],
+            widths=0.6,
+            patch_artist=True,
+            medianprops={"color": "black"},
         )
+        for patch, color in zip(bp["boxes"], ["#2ecc71", "#e74c3c"]):
+            patch.set_facecolor(color)
         title = f"{pop}\n(p={pval:.4f})"
-        if significant:
+        if results.at[pop, "significant"]:
             title += " *"
         axes[i].set_title(title, fontsize=11)
         axes[i].set_xlabel("Response")
         axes[i].set_ylabel("Relative Frequency (%)")
 
     fig.tight_layout()
+    return fig
 
-    stats_df = pd.DataFrame(stats_rows)
+
+def get_statistical_analysis(db_path=DB_PATH, conn=None):
+    """Compare responders vs non-responders for melanoma+miraclib+PBMC.
+
+    Returns:
+        df: DataFrame with columns (sample, subject, response, time_from_treatment_start,
+            population, count, percentage)
+        fig: matplotlib Figure with boxplots
+        stats_df: DataFrame with Mann-Whitney U test results per population
+
+    If ``conn`` is given it is used as-is and left open.
+    """
+    df, stats_df = get_statistical_tests(db_path, conn=conn)
+    fig = build_boxplot_figure(df, stats_df)
     return df, fig, stats_df
 
 
-def get_subset_analysis(db_path=DB_PATH):
+def get_subset_analysis(db_path=DB_PATH, conn=None):
     """Baseline melanoma PBMC samples treated with miraclib.
 
     Returns a dict with three DataFrames:
         project_counts: samples per project
         response_counts: subjects per response status
         sex_counts: subjects per sex
+
+    If ``conn`` is given it is used as-is and left open.
     """
-    conn = sqlite3.connect(db_path)
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(db_path)
 
     base_where = """
         WHERE sub.condition = 'melanoma'
@@ -137,46 +218,32 @@ def get_subset_analysis(db_path=DB_PATH):
           AND sub.treatment = 'miraclib'
     """
 
-    # Samples per project
-    project_counts = pd.read_sql_query(
+    # One pass over the cohort; the three breakdowns are cheap groupbys on top
+    df = pd.read_sql_query(
         f"""
-        SELECT sub.project, COUNT(*) AS sample_count
+        SELECT sub.project, sub.response, sub.sex, sa.sample, sa.subject
         FROM samples sa
         JOIN subjects sub ON sa.subject = sub.subject
         {base_where}
-        GROUP BY sub.project
-        ORDER BY sub.project
         """,
         conn,
     )
 
+    if own_conn:
+        conn.close()
+
+    subjects = df.drop_duplicates("subject")
+
+    # Samples per project
+    project_counts = df.groupby("project").size().reset_index(name="sample_count")
+
     # Responder vs non-responder subjects
-    response_counts = pd.read_sql_query(
-        f"""
-        SELECT sub.response, COUNT(DISTINCT sa.subject) AS subject_count
-        FROM samples sa
-        JOIN subjects sub ON sa.subject = sub.subject
-        {base_where}
-        GROUP BY sub.response
-        ORDER BY sub.response
-        """,
-        conn,
+    response_counts = (
+        subjects.groupby("response", dropna=False).size().reset_index(name="subject_count")
     )
 
     # Male vs female subjects
-    sex_counts = pd.read_sql_query(
-        f"""
-        SELECT sub.sex, COUNT(DISTINCT sa.subject) AS subject_count
-        FROM samples sa
-        JOIN subjects sub ON sa.subject = sub.subject
-        {base_where}
-        GROUP BY sub.sex
-        ORDER BY sub.sex
-        """,
-        conn,
-    )
-
-    conn.close()
+    sex_counts = subjects.groupby("sex").size().reset_index(name="subject_count")
 
     return {
         "project_counts": project_counts,
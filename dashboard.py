@@ -2,13 +2,22 @@
 """Dashboard for clinical trial data analysis."""
 
 import os
+import sqlite3
 import streamlit as st
 import pandas as pd
-
-from analysis import get_data_overview, get_statistical_analysis, get_subset_analysis
+import numpy as np
+import pyarrow.compute as pc
+
+from analysis import (
+    build_boxplot_figure,
+    get_data_overview,
+    get_statistical_tests,
+    get_subset_analysis,
+)
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(SCRIPT_DIR, "loblaw.db")
+BOXPLOT_PATH = os.path.join(SCRIPT_DIR, "boxplots.svg")
 
 st.set_page_config(
     page_title="Clinical Trial Analysis",
@@ -26,6 +35,17 @@ if not os.path.exists(DB_PATH):
     )
     st.stop()
 
+
+@st.cache_resource
+def get_conn():
+    """Shared read-only connection, reused across reruns."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.execute("PRAGMA query_only = 1")
+    conn.execute("PRAGMA cache_size = -64000")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
 tab1, tab2, tab3 = st.tabs([
     "Data Overview",
     "Statistical Analysis",
@@ -44,12 +64,35 @@ with tab1:
 
     @st.cache_data
     def load_summary():
-        return get_data_overview(DB_PATH)
-
-    summary_df = load_summary()
+        # An Arrow table goes to st.dataframe as-is, with no pandas conversion
+        table = get_data_overview(DB_PATH, conn=get_conn(), as_arrow=True)
+        # Sorted lower-cased IDs let prefix searches use a binary search
+        sample_lower = pc.utf8_lower(table["sample"])
+        order = pc.sort_indices(sample_lower)
+        table = table.take(order)
+        samples_lower = sample_lower.take(order).to_numpy().astype(str)
+        return table, samples_lower
+
+    summary_table, samples_lower = load_summary()
+
+    sample_search = st.text_input("Search by sample ID", placeholder="e.g. sample00012")
+    filtered = summary_table
+    if sample_search:
+        q = sample_search.lower()
+        lo = hi = 0
+        if q.isalnum():
+            lo = np.searchsorted(samples_lower, q, side="left")
+            hi = np.searchsorted(samples_lower, q + "\uffff", side="left")
+        if hi > lo:
+            filtered = summary_table.slice(lo, hi - lo)
+        else:
+            # Not a prefix of any ID; fall back to a plain substring match
+            filtered = summary_table.filter(
+                pc.match_substring(summary_table["sample"], sample_search, ignore_case=True)
+            )
 
     st.dataframe(
-        summary_df,
+        filtered,
         width='stretch',
         height=500,
         column_config={
@@ -60,7 +103,7 @@ with tab1:
             "percentage": st.column_config.NumberColumn("Percentage (%)", format="%.2f"),
         },
     )
-    st.caption(f"{len(summary_df):,} rows")
+    st.caption(f"{len(filtered):,} rows")
 
 # ---------------------------------------------------------------------------
 # Tab 2: Statistical Analysis
@@ -75,12 +118,23 @@ with tab2:
 
     @st.cache_data
     def load_stats():
-        df, fig, stats_df = get_statistical_analysis(DB_PATH)
-        return df, fig, stats_df
+        return get_statistical_tests(DB_PATH, conn=get_conn())
 
-    stats_data, stats_fig, stats_results = load_stats()
+    # Figures aren't worth pickling on every rerun; build one and keep it
+    @st.cache_resource
+    def load_stats_figure():
+        return build_boxplot_figure(*load_stats())
 
-    st.pyplot(stats_fig)
+    stats_data, stats_results = load_stats()
+
+    # Serve the SVG written by load_data.py unless the database is newer
+    if (
+        os.path.exists(BOXPLOT_PATH)
+        and os.path.getmtime(BOXPLOT_PATH) >= os.path.getmtime(DB_PATH)
+    ):
+        st.image(BOXPLOT_PATH, width="stretch")
+    else:
+        st.pyplot(load_stats_figure())
 
     st.subheader("Statistical Test Results")
     display_stats = stats_results.copy()
@@ -121,7 +175,7 @@ with tab3:
 
     @st.cache_data
     def load_subset():
-        return get_subset_analysis(DB_PATH)
+        return get_subset_analysis(DB_PATH, conn=get_conn())
 
     subset = load_subset()
 
@@ -4,13 +4,17 @@
 import csv
 import sqlite3
 import os
+import time
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(SCRIPT_DIR, "loblaw.db")
 CSV_PATH = os.path.join(SCRIPT_DIR, "data", "cell-count.csv")
+BOXPLOT_PATH = os.path.join(SCRIPT_DIR, "boxplots.svg")
 
 POPULATIONS = ["b_cell", "cd8_t_cell", "cd4_t_cell", "nk_cell", "monocyte"]
 
+MAX_VARIABLES = 999
+
 
 def create_schema(cursor):
     """Create the normalized database schema."""
@@ -41,77 +45,196 @@ def create_schema(cursor):
             FOREIGN KEY (sample) REFERENCES samples(sample)
         );
 
+        -- Denormalized copy of cell_counts, one row per sample, for read-heavy overviews
+        CREATE TABLE IF NOT EXISTS cell_counts_wide (
+            sample TEXT PRIMARY KEY,
+            b_cell INTEGER NOT NULL,
+            cd8_t_cell INTEGER NOT NULL,
+            cd4_t_cell INTEGER NOT NULL,
+            nk_cell INTEGER NOT NULL,
+            monocyte INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            FOREIGN KEY (sample) REFERENCES samples(sample)
+        );
+
         CREATE INDEX IF NOT EXISTS idx_samples_subject ON samples(subject);
         CREATE INDEX IF NOT EXISTS idx_cell_counts_sample ON cell_counts(sample);
         CREATE INDEX IF NOT EXISTS idx_cell_counts_population ON cell_counts(population);
+
+        -- Cover the condition/treatment/sample_type/timepoint filters used in analysis
+        CREATE INDEX IF NOT EXISTS idx_subjects_cond_treat ON subjects(condition, treatment, subject);
+        CREATE INDEX IF NOT EXISTS idx_samples_type_time_subj ON samples(sample_type, time_from_treatment_start, subject);
     """)
 
 
+def insert_rows(cursor, insert, columns, rows):
+    """Insert rows with multi-row VALUES statements rather than one row per statement.
+
+    ``insert`` is the statement head, e.g. "INSERT INTO samples".
+    """
+    # Stay under SQLite's historical 999 bound-parameter limit
+    chunk = max(1, MAX_VARIABLES // len(columns))
+    placeholder = f"({', '.join('?' * len(columns))})"
+    head = f"{insert} ({', '.join(columns)}) VALUES "
+
+    full_sql = head + ", ".join([placeholder] * chunk)
+    for start in range(0, len(rows), chunk):
+        batch = rows[start:start + chunk]
+        sql = full_sql if len(batch) == chunk else head + ", ".join([placeholder] * len(batch))
+        cursor.execute(sql, [value for row in batch for value in row])
+
+
 def load_csv(cursor, csv_path):
     """Read CSV and insert into normalized tables."""
-    seen_subjects = set()
+    subjects_rows = []
+    samples_rows = []
+    cc_rows = []
+    wide_rows = []
+
+    with open(csv_path, "r", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        idx = {name: i for i, name in enumerate(header)}
+
+        # Resolve column positions once instead of per row
+        subject_i = idx["subject"]
+        project_i = idx["project"]
+        condition_i = idx["condition"]
+        age_i = idx["age"]
+        sex_i = idx["sex"]
+        treatment_i = idx["treatment"]
+        response_i = idx["response"]
+        sample_i = idx["sample"]
+        sample_type_i = idx["sample_type"]
+        time_i = idx["time_from_treatment_start"]
+        population_cols = [(pop, idx[pop]) for pop in POPULATIONS]
 
-    with open(csv_path, "r") as f:
-        reader = csv.DictReader(f)
         for row in reader:
-            subj = row["subject"]
-
-            # Insert subject only once
-            if subj not in seen_subjects:
-                cursor.execute(
-                    "INSERT INTO subjects (subject, project, condition, age, sex, treatment, response) "
-                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (
-                        subj,
-                        row["project"],
-                        row["condition"],
-                        int(row["age"]),
-                        row["sex"],
-                        row["treatment"],
-                        row["response"] if row["response"] else None,
-                    ),
+            subj = row[subject_i]
+            sample = row[sample_i]
+
+            # Repeated subjects are dropped by INSERT OR IGNORE on the primary key
+            subjects_rows.append(
+                (
+                    subj,
+                    row[project_i],
+                    row[condition_i],
+                    int(row[age_i]),
+                    row[sex_i],
+                    row[treatment_i],
+                    row[response_i] if row[response_i] else None,
                 )
-                seen_subjects.add(subj)
+            )
 
-            # Insert sample
-            cursor.execute(
-                "INSERT INTO samples (sample, subject, sample_type, time_from_treatment_start) "
-                "VALUES (?, ?, ?, ?)",
+            samples_rows.append(
                 (
-                    row["sample"],
+                    sample,
                     subj,
-                    row["sample_type"],
-                    int(row["time_from_treatment_start"]),
-                ),
+                    row[sample_type_i],
+                    int(row[time_i]),
+                )
             )
 
             # Unpivot cell counts into rows
-            cell_count_rows = [
-                (row["sample"], pop, int(row[pop])) for pop in POPULATIONS
-            ]
-            cursor.executemany(
-                "INSERT INTO cell_counts (sample, population, count) VALUES (?, ?, ?)",
-                cell_count_rows,
-            )
+            sample_counts = [(sample, pop, int(row[ci])) for pop, ci in population_cols]
+            cc_rows.extend(sample_counts)
+            counts = [count for _, _, count in sample_counts]
+            wide_rows.append((sample, *counts, sum(counts)))
+
+    # One bulk insert per table
+    insert_rows(
+        cursor,
+        "INSERT OR IGNORE INTO subjects",
+        ["subject", "project", "condition", "age", "sex", "treatment", "response"],
+        subjects_rows,
+    )
+    insert_rows(
+        cursor,
+        "INSERT INTO samples",
+        ["sample", "subject", "sample_type", "time_from_treatment_start"],
+        samples_rows,
+    )
+    insert_rows(
+        cursor,
+        "INSERT INTO cell_counts",
+        ["sample", "population", "count"],
+        cc_rows,
+    )
+    insert_rows(
+        cursor,
+        "INSERT INTO cell_counts_wide",
+        ["sample", *POPULATIONS, "total"],
+        wide_rows,
+    )
+
+
+def cache_statistics(conn):
+    """Store the Part 3 test results so the dashboard can skip SciPy on reload."""
+    try:
+        from analysis import get_statistical_tests
+    except ImportError:
+        print("Skipping stats cache (analysis dependencies not installed)")
+        return
+
+    # Stamp the cache and the database with the same version; analysis.py
+    # ignores the cache if they ever disagree
+    version = int(time.time())
+    _, stats_df = get_statistical_tests(conn=conn)
+    stats_df.assign(db_version=version).to_sql(
+        "stats_cache", conn, if_exists="replace", index=False
+    )
+    conn.execute(f"PRAGMA user_version = {version}")
+    conn.commit()
+
+
+def export_boxplots(db_path, out_path):
+    """Render the Part 3 boxplots once so the dashboard can serve a static SVG."""
+    try:
+        from analysis import get_statistical_analysis
+    except ImportError:
+        # load_data.py itself only needs the standard library
+        print("Skipping boxplot export (analysis dependencies not installed)")
+        return
+
+    _, fig, _ = get_statistical_analysis(db_path)
+    fig.savefig(out_path, bbox_inches="tight")
+    print(f"Boxplots saved to {out_path}")
 
 
 def main():
-    # Remove existing DB for re-runs
-    if os.path.exists(DB_PATH):
-        os.remove(DB_PATH)
+    # Remove existing outputs for re-runs
+    for path in (DB_PATH, BOXPLOT_PATH):
+        if os.path.exists(path):
+            os.remove(path)
 
     conn = sqlite3.connect(DB_PATH)
     conn.execute("PRAGMA foreign_keys = ON")
+    # Bulk-load tuning: WAL + NORMAL sync avoids an fsync per commit
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -20000")
+    conn.execute("PRAGMA busy_timeout = 5000")
     cursor = conn.cursor()
 
     create_schema(cursor)
-    load_csv(cursor, CSV_PATH)
 
+    # Load every row inside one transaction instead of auto-committing
+    cursor.execute("BEGIN IMMEDIATE")
+    load_csv(cursor, CSV_PATH)
     conn.commit()
 
+    # Gather statistics so the planner picks the composite indexes
+    conn.execute("ANALYZE")
+
+    cache_statistics(conn)
+
     conn.close()
     print(f"\nDatabase created at {DB_PATH}")
 
+    # After close, so the WAL checkpoint can't leave the DB newer than the SVG
+    export_boxplots(DB_PATH, BOXPLOT_PATH)
+
 
 if __name__ == "__main__":
     main()